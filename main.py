@@ -1,19 +1,89 @@
-import json
+import contextlib
+import functools
+import logging
+import logging.handlers
 import os
+import tempfile
+import threading
 import time
+import uuid
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed, wait
 
 import requests
 from dotenv import load_dotenv
-from google.cloud import secretmanager, storage 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.cloud import secretmanager, storage
+from google.cloud.storage import transfer_manager
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+LOG_FORMAT = "%(asctime)s %(threadName)s %(levelname)s %(message)s"
+
 HTTP_OK = 200
+HTTP_ACCEPTED = 202
 workspace_name = os.getenv("WORKSPACE_NAME")
-ignore_reports = os.getenv("IGNORE_REPORTS")
+IGNORE_REPORTS = frozenset(json_loads(os.getenv("IGNORE_REPORTS") or "[]"))
 PROJECT_ID = os.getenv("PROJECT_ID")
+ARCHIVE_TO_GCS = os.getenv("ARCHIVE_TO_GCS", "true").lower() in ("1", "true", "yes")
+MAX_WORKERS = 8
+# Resumable upload chunks must be a multiple of GCS's 256 KiB upload quantum.
+GCS_CHUNK_SIZE = 8 * 256 * 1024
+GCS_UPLOAD_TIMEOUT = 600
+# Above this size a report is uploaded as concurrent chunks (parallel composite
+# upload); below it the extra compose requests cost more than they save.
+PARALLEL_UPLOAD_THRESHOLD = 100 * 1024 * 1024
+PARALLEL_UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+IMPORT_TIMEOUT = 30 * 60
+# Connect/read timeout for import status polls, so a hung GET cannot stall
+# wait_for_imports past its deadline.
+IMPORT_POLL_TIMEOUT = 30
+# Chunks buffered per consumer while teeing an export; bounds memory per report.
+TEE_QUEUE_SIZE = 8
+IMPORT_FINAL_STATES = {"Succeeded", "Failed"}
+
+POWERBI_API_URL = "https://api.powerbi.com"
+LOGIN_URL = "https://login.microsoftonline.com"
+TOKEN_URL_TMPL = LOGIN_URL + "/{tenant_id}/oauth2/token"
+GROUPS_URL = POWERBI_API_URL + "/v1.0/myorg/groups"
+REPORTS_URL_TMPL = GROUPS_URL + "/{gid}/reports"
+EXPORT_URL_TMPL = REPORTS_URL_TMPL + "/{rid}/Export"
+IMPORT_URL_TMPL = GROUPS_URL + "/{gid}/imports"
+IMPORT_STATUS_URL_TMPL = IMPORT_URL_TMPL + "/{iid}"
+
+_thread_local = threading.local()
+_workspace_ids = {}
+_workspace_ids_lock = threading.Lock()
+
+
+# HTTP session
+def get_session() -> requests.Session:
+    # requests.Session is not guaranteed thread-safe, so each worker thread
+    # gets its own pooled keep-alive session instead of sharing one.
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        # A session only ever serves its own thread, so the default pool
+        # sizes are plenty; the adapter is mounted for keep-alive and retries.
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        )
+        session.mount("https://", adapter)
+        _thread_local.session = session
+    return session
 
 
 # Secret
@@ -26,7 +96,7 @@ def get_secret(secret_name: str):
 
 
 # Access token
-def get_access_token(tenant_info) -> str:
+def request_access_token(tenant_info) -> dict:
     tenant_id = tenant_info.get("tenant_id")
     client_id = tenant_info.get("client_id")
     client_secret = tenant_info.get("client_secret")
@@ -42,153 +112,497 @@ def get_access_token(tenant_info) -> str:
         "username": username,
         "password": password,
     }
-    response = requests.post(
-        f"https://login.microsoftonline.com/{tenant_id}/oauth2/token",
+    response = get_session().post(
+        TOKEN_URL_TMPL.format(tenant_id=tenant_id),
         headers=headers,
         data=body,
     )
 
     if response.status_code != HTTP_OK:
-        print("Failed to get access token")
-        print("Status Code:", response.status_code)
-        print("Response Content:", response.content.decode())
+        logger.error(
+            "Failed to get access token. Status Code: %s, Response Content: %s",
+            response.status_code,
+            response.content.decode(),
+        )
 
     response.raise_for_status()
-    return response.json().get("access_token")
+    return response.json()
+
+
+def get_access_token(tenant_info) -> str:
+    return request_access_token(tenant_info).get("access_token")
+
+
+class TokenCache:
+    # Refresh tokens this many seconds before they actually expire so that
+    # requests already in flight do not fail with a 401.
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, tenants: dict):
+        self.tenants = tenants
+        self._tokens = {}
+        # One lock per tenant so refreshing one tenant never blocks the other.
+        self._locks = {tenant_key: threading.Lock() for tenant_key in tenants}
+
+    def get_token(self, tenant_key) -> str:
+        with self._locks[tenant_key]:
+            token, expires_at = self._tokens.get(tenant_key, (None, 0))
+            if token is None or time.monotonic() >= expires_at - self.EXPIRY_MARGIN:
+                token_response = request_access_token(self.tenants[tenant_key])
+                token = token_response.get("access_token")
+                expires_at = time.monotonic() + int(
+                    token_response.get("expires_in", 3600)
+                )
+                self._tokens[tenant_key] = (token, expires_at)
+            return token
+
+    def provider(self, tenant_key):
+        return functools.partial(self.get_token, tenant_key)
+
+
+def resolve_token(access_token) -> str:
+    # Power BI helpers accept either a raw token or a TokenCache provider.
+    return access_token() if callable(access_token) else access_token
 
 
 # Workspace
 def get_workspace(access_token, workspace_name):
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(
-        "https://api.powerbi.com/v1.0/myorg/groups", headers=headers
+    headers = {"Authorization": f"Bearer {resolve_token(access_token)}"}
+    # Let the service filter the groups instead of downloading all of them.
+    escaped_name = workspace_name.replace("'", "''")
+    response = get_session().get(
+        GROUPS_URL,
+        headers=headers,
+        params={"$filter": f"name eq '{escaped_name}'"},
     )
     response.raise_for_status()
-    ws = [
-        result
-        for result in response.json()["value"]
-        if result["name"] == workspace_name
-    ]
+    ws = json_loads(response.content)["value"]
     if len(ws) > 0:
-        return ws[0].get("id")
+        return ws[0]["id"]
+
+
+def get_workspace_id(tenant_info, access_token, workspace_name):
+    # Workspace ids never change for a run, so resolve each
+    # (tenant_id, workspace_name) pair only once.
+    key = (tenant_info.get("tenant_id"), workspace_name)
+    with _workspace_ids_lock:
+        if key in _workspace_ids:
+            return _workspace_ids[key]
+    workspace_id = get_workspace(access_token, workspace_name)
+    if workspace_id is not None:
+        with _workspace_ids_lock:
+            _workspace_ids[key] = workspace_id
+    return workspace_id
 
 
 # Report
-def get_reports(access_token, workspace_id: str) -> list:
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(
-        f"https://api.powerbi.com/v1.0/myorg/groups/{workspace_id}/reports",
+def get_reports(access_token, workspace_id: str) -> dict:
+    headers = {"Authorization": f"Bearer {resolve_token(access_token)}"}
+    response = get_session().get(
+        REPORTS_URL_TMPL.format(gid=workspace_id),
         headers=headers,
     )
 
     if response.status_code == HTTP_OK:
-        ws = [
-            {"id": result.get("id"), "name": result.get("name")}
-            for result in response.json().get("value")
-        ]
-        return ws
+        data = json_loads(response.content)
+        reports = {}
+        for result in data["value"]:
+            # Power BI allows duplicate report names; only one can be keyed.
+            if result["name"] in reports:
+                logger.warning(
+                    "Duplicate report name %s in workspace %s; ignoring report %s",
+                    result["name"],
+                    workspace_id,
+                    result["id"],
+                )
+                continue
+            reports[result["name"]] = result["id"]
+        return reports
     else:
-        print(
-            f"Error {response.status_code} -- Something went wrong when trying to retrieve the list of reports in the workspace {workspace_id}"
+        logger.error(
+            "Error %s -- Something went wrong when trying to retrieve the list of reports in the workspace %s",
+            response.status_code,
+            workspace_id,
         )
 
 
 # Export report
 def export_report(access_token, group_id, report_id):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{group_id}/reports/{report_id}/Export"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(url, headers=headers)
+    url = EXPORT_URL_TMPL.format(gid=group_id, rid=report_id)
+    headers = {"Authorization": f"Bearer {resolve_token(access_token)}"}
+    response = get_session().get(url, headers=headers, stream=True)
     response.raise_for_status()
-    return response.content
+    return response
 
 
 # Import report
-def import_report(access_token, group_id, report_name, report_content):
-    url = f"https://api.powerbi.com/v1.0/myorg/groups/{group_id}/imports?datasetDisplayName={report_name}"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "multipart/form-data",
-    }
-    file = {"file": report_content}
-    response = requests.post(url, headers=headers, files=file)
-    if response.status_code != 202:
-        print(response.json())
-        return None
-    return response.json()
+def escape_multipart_param(value):
+    # Same HTML5-style escaping urllib3 applies for files=: quotes and control
+    # characters (CR/LF included) are percent-encoded, backslashes doubled.
+    escaped = value.replace("\\", "\\\\").replace('"', "%22")
+    return "".join(
+        f"%{ord(char):02X}" if ord(char) < 0x20 and char != "\x1b" else char
+        for char in escaped
+    )
+
+
+def import_report_stream(access_token, group_id, report_name, chunk_queue):
+    # Build the multipart body by hand so the PBIX chunks can be sent as they
+    # arrive instead of being assembled in memory by requests' files=.
+    url = IMPORT_URL_TMPL.format(gid=group_id)
+    boundary = uuid.uuid4().hex
+    filename = escape_multipart_param(f"{report_name}.pbix")
+
+    def body():
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        yield from iter_queue(chunk_queue)
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    with drain_on_exit(chunk_queue):
+        headers = {
+            "Authorization": f"Bearer {resolve_token(access_token)}",
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+        }
+        response = get_session().post(
+            url,
+            headers=headers,
+            params={"datasetDisplayName": report_name},
+            data=body(),
+        )
+        if response.status_code != HTTP_ACCEPTED:
+            logger.error("Import failed for %s: %s", report_name, response.json())
+            return None
+        return response.json().get("id")
+
+
+def get_import_state(access_token, group_id, import_id):
+    url = IMPORT_STATUS_URL_TMPL.format(gid=group_id, iid=import_id)
+    headers = {"Authorization": f"Bearer {resolve_token(access_token)}"}
+    response = get_session().get(url, headers=headers, timeout=IMPORT_POLL_TIMEOUT)
+    response.raise_for_status()
+    return response.json().get("importState")
+
+
+def wait_for_imports(
+    access_token, group_id, import_ids, poll_interval=5, timeout=IMPORT_TIMEOUT
+):
+    # Imports complete asynchronously on the Power BI side; poll all pending
+    # ones concurrently each round until they settle or the timeout is hit.
+    pending = set(import_ids)
+    states = {}
+    deadline = time.monotonic() + timeout
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        while pending:
+            futures = {
+                executor.submit(
+                    get_import_state, access_token, group_id, import_id
+                ): import_id
+                for import_id in pending
+            }
+            try:
+                for future in as_completed(
+                    futures, timeout=max(deadline - time.monotonic(), 0)
+                ):
+                    import_id = futures[future]
+                    try:
+                        state = future.result()
+                    except requests.RequestException as e:
+                        # Transient failures leave the import pending; the
+                        # deadline decides when to give up on it.
+                        logger.warning("Polling import %s failed: %s", import_id, e)
+                        continue
+                    states[import_id] = state
+                    if state in IMPORT_FINAL_STATES:
+                        pending.discard(import_id)
+            except TimeoutError:
+                logger.warning("Timed out waiting for %s import(s)", len(pending))
+                break
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                break
+            time.sleep(min(poll_interval, remaining))
+    finally:
+        # Do not wait for polls still in flight once the deadline has passed.
+        executor.shutdown(wait=False, cancel_futures=True)
+    return states
+
+
+# Stream tee
+_END_OF_STREAM = object()
+
+
+class StreamAborted(Exception):
+    pass
+
+
+class ChunkQueue(Queue):
+    def __init__(self, maxsize=TEE_QUEUE_SIZE):
+        super().__init__(maxsize)
+        # Set once the consumer has read the end marker or the abort error.
+        self.finished = False
+
+
+def iter_queue(chunk_queue):
+    while not chunk_queue.finished:
+        chunk = chunk_queue.get()
+        if chunk is _END_OF_STREAM:
+            chunk_queue.finished = True
+            return
+        if isinstance(chunk, BaseException):
+            chunk_queue.finished = True
+            raise StreamAborted("Report export was interrupted") from chunk
+        yield chunk
+
+
+@contextlib.contextmanager
+def drain_on_exit(chunk_queue):
+    # A consumer that fails before reaching the end marker must keep reading
+    # until it does, otherwise the producer blocks forever on the bounded
+    # queue. Failures after the marker (e.g. the final flush) need no drain.
+    try:
+        yield
+    except BaseException:
+        if not chunk_queue.finished:
+            with contextlib.suppress(StreamAborted):
+                for _ in iter_queue(chunk_queue):
+                    pass
+        raise
+
+
+def tee_response(response, chunk_queue, spool=None):
+    # Chunks are also copied to the local spool file when given, so a slow
+    # reader of that copy never throttles the queued consumer.
+    try:
+        with response:
+            for chunk in response.iter_content(chunk_size=GCS_CHUNK_SIZE):
+                chunk_queue.put(chunk)
+                if spool is not None:
+                    spool.write(chunk)
+    except BaseException as e:
+        # Includes KeyboardInterrupt, so the consumer is never left waiting.
+        chunk_queue.put(e)
+        raise
+    chunk_queue.put(_END_OF_STREAM)
 
 
 # GCS Storge
-def upload_report_to_gcs(report_content, report_name):
+def get_report_blob(report_name):
     BUCKET_NAME = os.getenv("BUCKET_NAME")
     BUCKET_DESTINATION_DIRECTORY = os.getenv("BUCKET_DESTINATION_DIRECTORY")
     storage_client = storage.Client()
     bucket = storage_client.bucket(BUCKET_NAME)
     destination_blob_name = f"{BUCKET_DESTINATION_DIRECTORY}/{report_name}.pbix"
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_string(report_content)
-    print(f"Report {report_name} uploaded to {destination_blob_name}.")
+    return bucket.blob(destination_blob_name)
+
+
+def upload_file_concurrently(filename, blob):
+    # Thread workers: the default process workers would fork() this heavily
+    # threaded process, and the upload is I/O-bound anyway.
+    transfer_manager.upload_chunks_concurrently(
+        filename,
+        blob,
+        chunk_size=PARALLEL_UPLOAD_CHUNK_SIZE,
+        worker_type=transfer_manager.THREAD,
+        max_workers=MAX_WORKERS,
+        timeout=GCS_UPLOAD_TIMEOUT,
+    )
+
+
+def open_report_writer(blob):
+    return blob.open(
+        "wb",
+        chunk_size=GCS_CHUNK_SIZE,
+        ignore_flush=True,
+        timeout=GCS_UPLOAD_TIMEOUT,
+    )
+
+
+def archive_report_file(report_file, report_name):
+    # Takes ownership of the spooled export and deletes it once uploaded.
+    with report_file:
+        report_file.flush()
+        blob = get_report_blob(report_name)
+        if report_file.tell() > PARALLEL_UPLOAD_THRESHOLD:
+            upload_file_concurrently(report_file.name, blob)
+        else:
+            # Reads from the spooled file return exactly GCS_CHUNK_SIZE bytes
+            # (bar the last), so every write is a whole multiple of the upload
+            # quantum and the resumable writer sends it without re-buffering.
+            report_file.seek(0)
+            read_chunk = functools.partial(report_file.read, GCS_CHUNK_SIZE)
+            with open_report_writer(blob) as writer:
+                for chunk in iter(read_chunk, b""):
+                    writer.write(chunk)
+    logger.info("Report %s uploaded to %s.", report_name, blob.name)
+    return blob
 
 
 # ------------------------------------------------------------------------------------------------------------------------------------------------------------------->
+def load_workspace(token_cache, tenant_key, tenant_info):
+    token_cache.get_token(tenant_key)
+    access_token = token_cache.provider(tenant_key)
+    workspace_id = get_workspace_id(tenant_info, access_token, workspace_name)
+    return access_token, workspace_id, get_reports(access_token, workspace_id)
+
+
 def main():
+    if not workspace_name:
+        raise ValueError("WORKSPACE_NAME environment variable is not set")
 
-    secrets = json.loads(get_secret("vgm-secrets-powerbi-migration-tenant-creds"))
+    secrets = json_loads(get_secret("vgm-secrets-powerbi-migration-tenant-creds"))
     tenant_vgm_info = secrets.get("tenant_vgm_info", {})
     tenant_ft_info = secrets.get("tenant_ft_info", {})
 
-    # Get access token for Tenant VGM
-    token_vgm = get_access_token(tenant_vgm_info)
-    source_workspace_id = get_workspace(token_vgm, workspace_name)
-    source_reports_dict = get_reports(token_vgm, source_workspace_id)
-    print(
-        f"\nNumber of reports in the VGM '{workspace_name}' workspace : {len(source_reports_dict)}"
-    )
+    token_cache = TokenCache({"vgm": tenant_vgm_info, "ft": tenant_ft_info})
 
-    # Get access token for Tenant Fasttrack
-    token_ft = get_access_token(tenant_ft_info)
-    target_workspace_id = get_workspace(token_ft, workspace_name)
-    dst_reports_dict = get_reports(token_ft, target_workspace_id)
-    dst_reports_dict_by_name = {
-        report.get("name"): report for report in dst_reports_dict
-    }
-    print(
-        f"Number of reports in the FastTrack '{workspace_name}' workspace : {len(dst_reports_dict)}"
+    # The two tenants are independent, so resolve tokens, workspaces and
+    # report listings for both at the same time.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        source_future = executor.submit(
+            load_workspace, token_cache, "vgm", tenant_vgm_info
+        )
+        target_future = executor.submit(
+            load_workspace, token_cache, "ft", tenant_ft_info
+        )
+        token_vgm, source_workspace_id, source_reports = source_future.result()
+        token_ft, target_workspace_id, dst_reports = target_future.result()
+    logger.info(
+        "Number of reports in the VGM '%s' workspace : %s",
+        workspace_name,
+        len(source_reports),
+    )
+    logger.info(
+        "Number of reports in the FastTrack '%s' workspace : %s",
+        workspace_name,
+        len(dst_reports),
     )
 
-    for report in source_reports_dict:
-        report_name = report.get("name")
-        if report_name not in ignore_reports:
-            # Check if the report already exists in the destination
-            if report_name in dst_reports_dict_by_name:
-                print(
-                    f"\nINFO --Report {report_name} already exists in the destination. Skipping migration."
-                )
-                continue
-
-            start_time = time.time()
-            print("\nINFO --Report Migration Started for: ", report.get("name"))
-            print(report.get("id"))
-            # Export report from Tenant VGM
-            report_content = export_report(
-                token_vgm, source_workspace_id, report.get("id")
+    # GCS archival runs from spooled exports off the critical path; main waits
+    # for it before exiting.
+    archive_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    # Long-lived so each import thread keeps its pooled session between reports.
+    import_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    gcs_futures = {}
+    gcs_futures_lock = threading.Lock()
+
+    def migrate_one(report_name, report_id):
+        start_time = time.time()
+        logger.info("Report Migration Started for: %s (%s)", report_name, report_id)
+        try:
+            import_id = migrate_report(report_name, report_id)
+        except Exception:
+            logger.exception("Error while migrating report %s", report_name)
+            return report_name, False, None, time.time() - start_time
+        return report_name, True, import_id, time.time() - start_time
+
+    def migrate_report(report_name, report_id):
+        # Export report from Tenant VGM
+        export_response = export_report(token_vgm, source_workspace_id, report_id)
+
+        # Stream the export into the Power BI import and, when archiving is
+        # enabled, spool a copy to disk that is uploaded to GCS in the
+        # background once the export is complete.
+        # Everything that can fail before tee_response runs happens before the
+        # import is submitted, since only tee_response ends the import's queue.
+        spool = tempfile.NamedTemporaryFile(suffix=".pbix") if ARCHIVE_TO_GCS else None
+        import_queue = ChunkQueue()
+        try:
+            import_future = import_executor.submit(
+                import_report_stream,
+                token_ft,
+                target_workspace_id,
+                report_name,
+                import_queue,
             )
-            if report_content:
-                upload_report_to_gcs(report_content, report_name)
-                import_response = import_report(
-                    token_ft, target_workspace_id, report.get("name"), report_content
-                )
-                print(
-                    "INFO --Report Migration Successful for Report ID: ",
-                    import_response,
-                )
-                dst_reports_dict.append(report)
+            tee_response(export_response, import_queue, spool)
+        except BaseException:
+            if spool is not None:
+                spool.close()
+            raise
+        if spool is not None:
+            gcs_future = archive_executor.submit(
+                archive_report_file, spool, report_name
+            )
+            with gcs_futures_lock:
+                gcs_futures[gcs_future] = report_name
+        return import_future.result()
+
+    reports_to_migrate = []
+    for report_name, report_id in source_reports.items():
+        if report_name in IGNORE_REPORTS:
+            continue
+        # Check if the report already exists in the destination
+        if report_name in dst_reports:
+            logger.info(
+                "Report %s already exists in the destination. Skipping migration.",
+                report_name,
+            )
+            continue
+        reports_to_migrate.append((report_name, report_id))
+
+    import_ids = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(migrate_one, report_name, report_id)
+            for report_name, report_id in reports_to_migrate
+        ]
+        for future in as_completed(futures):
+            report_name, success, import_id, execution_time = future.result()
+            if success and import_id:
+                logger.info("Report Migration Successful for Report ID: %s", import_id)
+                import_ids[import_id] = report_name
+            else:
+                logger.error("Report Migration Failed for: %s", report_name)
+            logger.info(
+                "Migration of %s took %.2f seconds!", report_name, execution_time
+            )
+    import_executor.shutdown()
+
+    if import_ids:
+        import_states = wait_for_imports(token_ft, target_workspace_id, import_ids)
+        for import_id, report_name in import_ids.items():
+            state = import_states.get(import_id)
+            if state == "Succeeded":
+                logger.info("Import completed for: %s", report_name)
             else:
-                print("ERROR -- Report Migration Failed for:", report.get("name"))
+                logger.error("Import %s for: %s", state or "Unknown", report_name)
+
+    wait(gcs_futures)
+    archive_executor.shutdown()
+    for gcs_future, report_name in gcs_futures.items():
+        if gcs_future.exception():
+            logger.error(
+                "Archiving to GCS failed for: %s (%s)",
+                report_name,
+                gcs_future.exception(),
+            )
+
 
-            end_time = time.time()
-            execution_time = end_time - start_time
-            print(f"Migration took  {execution_time:.2f} seconds!")
+def configure_logging():
+    # Worker threads only enqueue records; a single listener thread does the
+    # actual (blocking) writes to stderr.
+    log_queue = Queue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    # Attach the QueueHandler directly: basicConfig would give it a default
+    # formatter, and QueueHandler.prepare() would bake that prefix into the
+    # message before the listener formats it again.
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
 
 
 if __name__ == "__main__":
-    main()
+    log_listener = configure_logging()
+    try:
+        main()
+    finally:
+        log_listener.stop()
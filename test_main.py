@@ -3,23 +3,43 @@ from unittest.mock import patch, MagicMock, mock_open
 import os
 import json
 import io
+import logging
+import requests
+import tempfile
+import threading
+import time
 
 # Import the functions from your script
+import main as main_module
 from main import (
     get_secret,
     get_access_token,
+    TokenCache,
     get_workspace,
+    get_workspace_id,
     get_reports,
     export_report,
-    import_report,
-    upload_report_to_gcs,
+    wait_for_imports,
+    archive_report_file,
+    PARALLEL_UPLOAD_CHUNK_SIZE,
+    import_report_stream,
+    escape_multipart_param,
+    tee_response,
+    iter_queue,
+    ChunkQueue,
+    StreamAborted,
+    configure_logging,
     main,
 )
 
 
 class TestPowerBIMigration(unittest.TestCase):
 
-    @patch("powerbi_migration.secretmanager.SecretManagerServiceClient")
+    def setUp(self):
+        # Workspace ids are memoised per process; keep tests independent.
+        main_module._workspace_ids.clear()
+
+    @patch("main.secretmanager.SecretManagerServiceClient")
     def test_get_secret(self, mock_secret_manager_client):
         mock_client_instance = mock_secret_manager_client.return_value
         mock_access_secret_version = mock_client_instance.access_secret_version
@@ -30,8 +50,9 @@ class TestPowerBIMigration(unittest.TestCase):
         secret = get_secret("fake-secret-name")
         self.assertEqual(secret, '{"key": "value"}')
 
-    @patch("powerbi_migration.requests.post")
-    def test_get_access_token(self, mock_post):
+    @patch("main.get_session")
+    def test_get_access_token(self, mock_get_session):
+        mock_post = mock_get_session.return_value.post
         mock_post.return_value.status_code = 200
         mock_post.return_value.json.return_value = {"access_token": "fake_token"}
 
@@ -46,141 +67,454 @@ class TestPowerBIMigration(unittest.TestCase):
         token = get_access_token(tenant_info)
         self.assertEqual(token, "fake_token")
 
-    @patch("powerbi_migration.requests.get")
-    def test_get_workspace(self, mock_get):
+    @patch("main.time.monotonic")
+    @patch("main.request_access_token")
+    def test_token_cache_refreshes_near_expiry(
+        self, mock_request_access_token, mock_monotonic
+    ):
+        mock_request_access_token.side_effect = [
+            {"access_token": "token_1", "expires_in": "3600"},
+            {"access_token": "token_2", "expires_in": "3600"},
+        ]
+        token_cache = TokenCache({"vgm": {"tenant_id": "fake_tenant_id"}})
+
+        mock_monotonic.return_value = 0
+        self.assertEqual(token_cache.get_token("vgm"), "token_1")
+        mock_monotonic.return_value = 3000
+        self.assertEqual(token_cache.provider("vgm")(), "token_1")
+        mock_monotonic.return_value = 3550
+        self.assertEqual(token_cache.get_token("vgm"), "token_2")
+        self.assertEqual(mock_request_access_token.call_count, 2)
+
+    @patch("main.get_session")
+    def test_get_workspace(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
         mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {
-            "value": [{"id": "fake_workspace_id", "name": "fake_workspace"}]
-        }
+        mock_get.return_value.content = json.dumps(
+            {"value": [{"id": "fake_workspace_id", "name": "fake_workspace"}]}
+        ).encode()
 
         token = "fake_token"
         workspace_id = get_workspace(token, "fake_workspace")
         self.assertEqual(workspace_id, "fake_workspace_id")
+        self.assertEqual(
+            mock_get.call_args.kwargs["params"], {"$filter": "name eq 'fake_workspace'"}
+        )
 
-    @patch("powerbi_migration.requests.get")
-    def test_get_reports(self, mock_get):
+    @patch("main.get_workspace")
+    def test_get_workspace_id_is_cached(self, mock_get_workspace):
+        mock_get_workspace.return_value = "fake_workspace_id"
+        tenant_info = {"tenant_id": "fake_tenant_id"}
+
+        first = get_workspace_id(tenant_info, "fake_token", "fake_workspace")
+        second = get_workspace_id(tenant_info, "other_token", "fake_workspace")
+        self.assertEqual(first, "fake_workspace_id")
+        self.assertEqual(second, "fake_workspace_id")
+        mock_get_workspace.assert_called_once_with("fake_token", "fake_workspace")
+
+    @patch("main.get_session")
+    def test_get_reports(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
         mock_get.return_value.status_code = 200
-        mock_get.return_value.json.return_value = {
-            "value": [{"id": "fake_report_id", "name": "fake_report"}]
-        }
+        mock_get.return_value.content = json.dumps(
+            {"value": [{"id": "fake_report_id", "name": "fake_report"}]}
+        ).encode()
 
         token = "fake_token"
         workspace_id = "fake_workspace_id"
         reports = get_reports(token, workspace_id)
-        self.assertEqual(reports, [{"id": "fake_report_id", "name": "fake_report"}])
+        self.assertEqual(reports, {"fake_report": "fake_report_id"})
 
-    @patch("powerbi_migration.requests.get")
-    def test_export_report(self, mock_get):
+    @patch("main.get_session")
+    def test_get_reports_warns_on_duplicate_names(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.content = json.dumps(
+            {
+                "value": [
+                    {"id": "report_id_1", "name": "fake_report"},
+                    {"id": "report_id_2", "name": "fake_report"},
+                ]
+            }
+        ).encode()
+
+        with self.assertLogs("main", level="WARNING") as logs:
+            reports = get_reports("fake_token", "fake_workspace_id")
+        self.assertEqual(reports, {"fake_report": "report_id_1"})
+        self.assertIn("Duplicate report name fake_report", logs.output[0])
+
+    @patch("main.get_session")
+    def test_export_report(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
         mock_get.return_value.status_code = 200
-        mock_get.return_value.content = b"fake_report_content"
 
         token = "fake_token"
         group_id = "fake_group_id"
         report_id = "fake_report_id"
 
-        with patch("builtins.open", mock_open()) as mock_file:
-            try:
-                content = export_report(token, group_id, report_id)
-                self.assertEqual(content, b"fake_report_content")
-            except Exception as e:
-                self.fail(f"export_report raised an exception: {e}")
+        response = export_report(token, group_id, report_id)
+        self.assertIs(response, mock_get.return_value)
+        self.assertTrue(mock_get.call_args.kwargs["stream"])
 
-    @patch("powerbi_migration.requests.post")
-    def test_import_report(self, mock_post):
-        mock_post.return_value.status_code = 202
-        mock_post.return_value.json.return_value = {"import_id": "fake_import_id"}
+    @patch("main.time.sleep")
+    @patch("main.get_import_state")
+    def test_wait_for_imports(self, mock_get_import_state, mock_sleep):
+        states = {
+            "import_1": iter(["Publishing", "Succeeded"]),
+            "import_2": iter(["Failed"]),
+        }
+        mock_get_import_state.side_effect = lambda token, group_id, import_id: next(
+            states[import_id]
+        )
 
-        token = "fake_token"
-        group_id = "fake_group_id"
-        report_name = "fake_report"
-        report_content = b"fake_report_content"
-
-        result = import_report(token, group_id, report_name, report_content)
-        self.assertEqual(result, {"import_id": "fake_import_id"})
-
-    @patch("powerbi_migration.storage.Client")
-    def test_upload_report_to_gcs(self, mock_storage_client):
-        mock_client_instance = mock_storage_client.return_value
-        mock_bucket = mock_client_instance.bucket.return_value
-        mock_blob = mock_bucket.blob.return_value
-
-        report_content = b"fake_report_content"
-        report_name = "fake_report"
-
-        os.environ["BUCKET_NAME"] = "fake_bucket"
-        os.environ["BUCKET_DESTINATION_DIRECTORY"] = "fake_directory"
-
-        upload_report_to_gcs(report_content, report_name)
-        mock_blob.upload_from_string.assert_called_once_with(report_content)
-        print(
-            f"Report {report_name} uploaded to {os.getenv('BUCKET_DESTINATION_DIRECTORY')}/{report_name}.pbix."
-        )
-
-    @patch("powerbi_migration.get_secret")
-    @patch("powerbi_migration.get_access_token")
-    @patch("powerbi_migration.get_workspace")
-    @patch("powerbi_migration.get_reports")
-    @patch("powerbi_migration.export_report")
-    @patch("powerbi_migration.upload_report_to_gcs")
-    @patch("powerbi_migration.import_report")
-    @patch.dict(
-        os.environ,
-        {
-            "WORKSPACE_NAME": "fake_workspace",
-            "IGNORE_REPORTS": '["ignore_report_1", "ignore_report_2"]',
-            "PROJECT_ID": "fake_project_id",
-        },
-    )
-    def test_main(
-        self,
-        mock_import_report,
-        mock_upload_report_to_gcs,
-        mock_export_report,
-        mock_get_reports,
-        mock_get_workspace,
-        mock_get_access_token,
-        mock_get_secret,
+        result = wait_for_imports(
+            "fake_token", "fake_group_id", ["import_1", "import_2"], poll_interval=0
+        )
+        self.assertEqual(result, {"import_1": "Succeeded", "import_2": "Failed"})
+        self.assertEqual(mock_get_import_state.call_count, 3)
+
+    @patch("main.time.sleep")
+    @patch("main.get_import_state")
+    def test_wait_for_imports_retries_failed_polls(
+        self, mock_get_import_state, mock_sleep
+    ):
+        mock_get_import_state.side_effect = [
+            requests.ConnectionError("connection reset"),
+            "Succeeded",
+        ]
+
+        result = wait_for_imports(
+            "fake_token", "fake_group_id", ["import_1"], poll_interval=0
+        )
+        self.assertEqual(result, {"import_1": "Succeeded"})
+        self.assertEqual(mock_get_import_state.call_count, 2)
+
+    @patch("main.get_import_state")
+    def test_wait_for_imports_stops_at_deadline_when_poll_hangs(
+        self, mock_get_import_state
+    ):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        mock_get_import_state.side_effect = lambda token, group_id, import_id: (
+            release.wait() and "Succeeded"
+        )
+
+        start = time.monotonic()
+        result = wait_for_imports(
+            "fake_token", "fake_group_id", ["import_1"], poll_interval=0, timeout=0.2
+        )
+        self.assertEqual(result, {})
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_tee_response(self):
+        mock_response = MagicMock()
+        mock_response.iter_content.return_value = [b"chunk_1", b"chunk_2"]
+        chunk_queue = ChunkQueue()
+        spool = io.BytesIO()
+
+        tee_response(mock_response, chunk_queue, spool)
+        self.assertEqual(list(iter_queue(chunk_queue)), [b"chunk_1", b"chunk_2"])
+        self.assertEqual(spool.getvalue(), b"chunk_1chunk_2")
+
+    def test_tee_response_aborts_consumers(self):
+        mock_response = MagicMock()
+        mock_response.iter_content.side_effect = IOError("connection reset")
+        chunk_queue = ChunkQueue()
+
+        with self.assertRaises(IOError):
+            tee_response(mock_response, chunk_queue)
+        with self.assertRaises(StreamAborted):
+            list(iter_queue(chunk_queue))
+
+    def test_tee_response_aborts_consumers_on_keyboard_interrupt(self):
+        mock_response = MagicMock()
+        mock_response.iter_content.side_effect = KeyboardInterrupt
+        chunk_queue = ChunkQueue()
+
+        with self.assertRaises(KeyboardInterrupt):
+            tee_response(mock_response, chunk_queue)
+        with self.assertRaises(StreamAborted):
+            list(iter_queue(chunk_queue))
+
+    @patch("main.storage.Client")
+    def test_archive_report_file(self, mock_storage_client):
+        mock_blob = mock_storage_client.return_value.bucket.return_value.blob.return_value
+        mock_file = mock_blob.open.return_value.__enter__.return_value
+        spool = tempfile.NamedTemporaryFile(suffix=".pbix")
+        spool.write(b"fake")
+
+        blob = archive_report_file(spool, "fake_report")
+        self.assertIs(blob, mock_blob)
+        self.assertEqual(mock_blob.open.call_args.kwargs["chunk_size"] % (256 * 1024), 0)
+        self.assertTrue(mock_blob.open.call_args.kwargs["ignore_flush"])
+        mock_file.write.assert_called_once_with(b"fake")
+        self.assertTrue(spool.closed)
+
+    @patch("main.GCS_CHUNK_SIZE", 4)
+    @patch("main.storage.Client")
+    def test_archive_report_file_writes_aligned_chunks(self, mock_storage_client):
+        mock_blob = mock_storage_client.return_value.bucket.return_value.blob.return_value
+        mock_file = mock_blob.open.return_value.__enter__.return_value
+        spool = tempfile.NamedTemporaryFile(suffix=".pbix")
+        # Unaligned pieces, as urllib3 yields for chunked or gzip responses.
+        spool.write(b"012")
+        spool.write(b"3456789")
+
+        archive_report_file(spool, "fake_report")
+        written = [call.args[0] for call in mock_file.write.call_args_list]
+        self.assertEqual(written, [b"0123", b"4567", b"89"])
+
+    @patch("main.PARALLEL_UPLOAD_THRESHOLD", 2)
+    @patch("main.transfer_manager.upload_chunks_concurrently")
+    @patch("main.storage.Client")
+    def test_archive_report_file_large(
+        self, mock_storage_client, mock_upload_chunks_concurrently
+    ):
+        mock_blob = mock_storage_client.return_value.bucket.return_value.blob.return_value
+        spool = tempfile.NamedTemporaryFile(suffix=".pbix")
+        spool.write(b"fake")
+
+        archive_report_file(spool, "fake_report")
+        mock_upload_chunks_concurrently.assert_called_once_with(
+            spool.name,
+            mock_blob,
+            chunk_size=PARALLEL_UPLOAD_CHUNK_SIZE,
+            worker_type="thread",
+            max_workers=8,
+            timeout=600,
+        )
+        mock_blob.open.assert_not_called()
+
+    def run_tee_against(self, consumer, chunk_queue):
+        # Fail the test instead of hanging if the producer deadlocks.
+        response = MagicMock(iter_content=lambda chunk_size: [b"a", b"b", b"c"])
+        producer = threading.Thread(target=tee_response, args=(response, chunk_queue))
+        producer.start()
+        with self.assertRaises(IOError):
+            consumer()
+        producer.join(timeout=5)
+        self.assertFalse(producer.is_alive())
+
+    @patch("main.get_session")
+    def test_import_report_stream_drains_on_setup_failure(self, mock_get_session):
+        chunk_queue = ChunkQueue(maxsize=1)
+
+        def failing_token():
+            raise IOError("token refresh failed")
+
+        self.run_tee_against(
+            lambda: import_report_stream(
+                failing_token, "fake_group_id", "fake_report", chunk_queue
+            ),
+            chunk_queue,
+        )
+        mock_get_session.return_value.post.assert_not_called()
+
+    @patch("main.get_session")
+    def test_import_report_stream_failure_after_body_does_not_block(
+        self, mock_get_session
     ):
-        # Setup the mocks
-        mock_get_secret.return_value = json.dumps(
+        def post(url, headers, params, data):
+            b"".join(data)
+            raise IOError("connection reset while reading response")
+
+        mock_get_session.return_value.post.side_effect = post
+        chunk_queue = ChunkQueue(maxsize=1)
+
+        consumer = threading.Thread(
+            target=self.run_tee_against,
+            args=(
+                lambda: import_report_stream(
+                    "fake_token", "fake_group_id", "fake_report", chunk_queue
+                ),
+                chunk_queue,
+            ),
+        )
+        consumer.start()
+        consumer.join(timeout=5)
+        self.assertFalse(consumer.is_alive())
+
+    @patch("main.get_session")
+    def test_import_report_stream(self, mock_get_session):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value.status_code = 202
+        mock_post.return_value.json.return_value = {"id": "fake_import_id"}
+        mock_post.side_effect = lambda url, headers, params, data: (
+            setattr(self, "body", b"".join(data)) or mock_post.return_value
+        )
+        chunk_queue = ChunkQueue()
+        tee_response(MagicMock(iter_content=lambda chunk_size: [b"fake"]), chunk_queue)
+
+        result = import_report_stream("fake_token", "fake_group_id", "fake_report", chunk_queue)
+        self.assertEqual(result, "fake_import_id")
+        self.assertEqual(
+            mock_post.call_args.args[0],
+            "https://api.powerbi.com/v1.0/myorg/groups/fake_group_id/imports",
+        )
+        self.assertEqual(
+            mock_post.call_args.kwargs["params"], {"datasetDisplayName": "fake_report"}
+        )
+        self.assertIn(b'filename="fake_report.pbix"', self.body)
+        self.assertIn(b"\r\n\r\nfake\r\n--", self.body)
+
+    def test_escape_multipart_param(self):
+        self.assertEqual(
+            escape_multipart_param('Sales "Q1"\r\nreport\\draft.pbix'),
+            "Sales %22Q1%22%0D%0Areport\\\\draft.pbix",
+        )
+
+    @patch("main.workspace_name", None)
+    @patch("main.get_secret")
+    def test_main_requires_workspace_name(self, mock_get_secret):
+        with self.assertRaisesRegex(ValueError, "WORKSPACE_NAME"):
+            main()
+        mock_get_secret.assert_not_called()
+
+    def test_configure_logging(self):
+        root_logger = logging.getLogger()
+        self.addCleanup(setattr, root_logger, "handlers", list(root_logger.handlers))
+        self.addCleanup(root_logger.setLevel, root_logger.level)
+
+        with patch("sys.stderr", new_callable=io.StringIO) as mock_stderr:
+            listener = configure_logging()
+            logging.getLogger("main").info("Report %s uploaded", "fake_report")
+            listener.stop()
+        output = mock_stderr.getvalue()
+
+        self.assertEqual(output.count("\n"), 1)
+        self.assertRegex(output, r" MainThread INFO Report fake_report uploaded\n$")
+        self.assertNotIn("INFO:main:", output)
+
+    def patch_migration(self, source_reports, dst_reports):
+        # Stub every network boundary of main(). Both tenants are loaded
+        # concurrently, so the mocks are keyed by argument, not call order.
+        mocks = {}
+        for name in (
+            "get_secret",
+            "request_access_token",
+            "get_workspace",
+            "get_reports",
+            "export_report",
+            "archive_report_file",
+            "import_report_stream",
+            "wait_for_imports",
+        ):
+            patcher = patch(f"main.{name}")
+            mocks[name] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+        tenant_info = {
+            "client_id": "fake_client_id",
+            "client_secret": "fake_client_secret",
+            "username": "fake_username",
+            "password": "fake_password",
+        }
+        mocks["get_secret"].return_value = json.dumps(
             {
-                "tenant_vgm_info": {
-                    "tenant_id": "fake_tenant_id",
-                    "client_id": "fake_client_id",
-                    "client_secret": "fake_client_secret",
-                    "username": "fake_username",
-                    "password": "fake_password",
-                },
-                "tenant_ft_info": {
-                    "tenant_id": "fake_tenant_id",
-                    "client_id": "fake_client_id",
-                    "client_secret": "fake_client_secret",
-                    "username": "fake_username",
-                    "password": "fake_password",
-                },
+                "tenant_vgm_info": {**tenant_info, "tenant_id": "fake_vgm_tenant_id"},
+                "tenant_ft_info": {**tenant_info, "tenant_id": "fake_ft_tenant_id"},
             }
         )
+        mocks["request_access_token"].side_effect = lambda tenant_info: {
+            "access_token": f"token_{tenant_info['tenant_id']}",
+            "expires_in": "3600",
+        }
+        mocks["get_workspace"].side_effect = lambda access_token, name: {
+            "token_fake_vgm_tenant_id": "source_workspace_id",
+            "token_fake_ft_tenant_id": "target_workspace_id",
+        }[access_token()]
+        mocks["get_reports"].side_effect = lambda access_token, workspace_id: {
+            "source_workspace_id": source_reports,
+            "target_workspace_id": dst_reports,
+        }[workspace_id]
+        mocks["export_report"].return_value.iter_content.return_value = [b"fake"]
+        # archive_report_file owns the spooled export, so close it in its place.
+        mocks["archive_report_file"].side_effect = lambda report_file, report_name: (
+            report_file.close()
+        )
+        mocks["import_report_stream"].return_value = "fake_import_id"
+        mocks["wait_for_imports"].return_value = {"fake_import_id": "Succeeded"}
+        return mocks
 
-        mock_get_access_token.side_effect = ["fake_token_vgm", "fake_token_ft"]
-        mock_get_workspace.side_effect = ["source_workspace_id", "target_workspace_id"]
-        mock_get_reports.side_effect = [[{"id": "report_id_1", "name": "Report 1"}], []]
-        mock_export_report.return_value = b"fake_report_content"
-        mock_import_report.return_value = {"import_id": "fake_import_id"}
+    def test_main(self):
+        mocks = self.patch_migration({"Report 1": "report_id_1"}, {})
 
-        with patch("sys.stdout", new_callable=io.StringIO) as mock_stdout:
+        with self.assertLogs("main", level="INFO") as logs:
             main()
-            output = mock_stdout.getvalue()
+        output = "\n".join(logs.output)
 
-        self.assertIn("INFO --Report Migration Started for:  Report 1", output)
+        self.assertIn("Report Migration Started for: Report 1", output)
         self.assertIn(
-            "INFO --Report Migration Successful for Report ID:  {'import_id': 'fake_import_id'}",
+            "Report Migration Successful for Report ID: fake_import_id",
             output,
         )
-        self.assertIn("Migration took ", output)
-        mock_upload_report_to_gcs.assert_called_once_with(
-            b"fake_report_content", "Report 1"
+        self.assertIn("Import completed for: Report 1", output)
+        self.assertIn("Migration of Report 1 took ", output)
+        mocks["archive_report_file"].assert_called_once()
+        self.assertEqual(mocks["archive_report_file"].call_args.args[1], "Report 1")
+
+    def test_main_continues_after_failed_report(self):
+        mocks = self.patch_migration(
+            {"Report 1": "report_id_1", "Report 2": "report_id_2"}, {}
+        )
+
+        def export(access_token, group_id, report_id):
+            if report_id == "report_id_1":
+                raise IOError("export failed")
+            return MagicMock(iter_content=lambda chunk_size: [b"fake"])
+
+        mocks["export_report"].side_effect = export
+
+        with self.assertLogs("main", level="INFO") as logs:
+            main()
+        output = "\n".join(logs.output)
+
+        self.assertIn("Report Migration Failed for: Report 1", output)
+        self.assertIn("Import completed for: Report 2", output)
+        mocks["wait_for_imports"].assert_called_once()
+
+    @patch("main.tempfile.NamedTemporaryFile")
+    def test_main_does_not_hang_when_spool_fails(self, mock_named_temporary_file):
+        mocks = self.patch_migration({"Report 1": "report_id_1"}, {})
+        mock_named_temporary_file.side_effect = OSError("disk full")
+
+        def run_main():
+            with self.assertLogs("main", level="INFO") as logs:
+                main()
+            self.output = "\n".join(logs.output)
+
+        runner = threading.Thread(target=run_main)
+        runner.start()
+        runner.join(timeout=5)
+        self.assertFalse(runner.is_alive())
+        self.assertIn("Report Migration Failed for: Report 1", self.output)
+        mocks["import_report_stream"].assert_not_called()
+
+    @patch("main.IGNORE_REPORTS", frozenset({"Ignored Report"}))
+    def test_main_skips_ignored_reports(self):
+        mocks = self.patch_migration(
+            {
+                "Ignored Report": "report_id_1",
+                # A substring of the ignored name must still be migrated.
+                "Ignored": "report_id_2",
+            },
+            {},
         )
 
+        main()
+        exported_ids = [
+            call.args[2] for call in mocks["export_report"].call_args_list
+        ]
+        self.assertEqual(exported_ids, ["report_id_2"])
+
+    @patch("main.ARCHIVE_TO_GCS", False)
+    def test_main_without_gcs_archive(self):
+        mocks = self.patch_migration({"Report 1": "report_id_1"}, {})
+
+        main()
+        mocks["import_report_stream"].assert_called_once()
+        mocks["archive_report_file"].assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()